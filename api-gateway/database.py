@@ -1,8 +1,10 @@
 import os
 import asyncio
-from sqlalchemy import create_engine
+import uuid
+from sqlalchemy import create_engine, event, inspect, select, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from models import Base, User
 import logging
 
@@ -13,24 +15,83 @@ logger = logging.getLogger(__name__)
 # 数据库配置
 DATABASE_DIR = "/app/database"
 DATABASE_URL = f"sqlite+aiosqlite:///{DATABASE_DIR}/conversations.db"
+READONLY_DATABASE_URL = f"sqlite+aiosqlite:///file:{DATABASE_DIR}/conversations.db?mode=ro&uri=true"
 SYNC_DATABASE_URL = f"sqlite:///{DATABASE_DIR}/conversations.db"
 
-# 创建异步引擎
-engine = create_async_engine(
+# SQLite连接参数：NORMAL同步配合WAL，提交无需每次fsync
+SQLITE_PRAGMAS = (
+    "synchronous=NORMAL",
+    "busy_timeout=5000",
+    "cache_size=-65536",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "foreign_keys=ON",
+)
+# 旧版本以36字符文本存储的UUID列，迁移时转换为16字节BLOB
+GUID_COLUMNS = (
+    ("sessions", "id"),
+    ("messages", "id"),
+    ("messages", "session_id"),
+    ("request_logs", "id"),
+    ("request_logs", "session_id"),
+)
+
+# journal_mode会写入数据库文件，只能由写连接设置
+SQLITE_WRITER_PRAGMAS = ("journal_mode=WAL",) + SQLITE_PRAGMAS
+
+def _sqlite_pragma_listener(pragmas):
+    """生成在新建连接时设置SQLite参数的监听函数"""
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+    return apply_pragmas
+
+# aiosqlite默认使用NullPool，这里显式启用连接池以复用连接
+# 写引擎：单连接，事务以BEGIN IMMEDIATE开始，避免读锁升级时的SQLITE_BUSY
+engine_rw = create_async_engine(
     DATABASE_URL,
     echo=False,
     pool_pre_ping=True,
-    pool_recycle=300
+    pool_recycle=300,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=1,
+    max_overflow=0,
+    connect_args={"isolation_level": "IMMEDIATE"}
+)
+event.listen(engine_rw.sync_engine, "connect", _sqlite_pragma_listener(SQLITE_WRITER_PRAGMAS))
+
+# 读引擎：只读连接池，多个读者可并发读取WAL快照
+engine_ro = create_async_engine(
+    READONLY_DATABASE_URL,
+    echo=False,
+    pool_pre_ping=True,
+    pool_recycle=300,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=(os.cpu_count() or 1) * 2
 )
+event.listen(engine_ro.sync_engine, "connect", _sqlite_pragma_listener(SQLITE_PRAGMAS))
 
 # 创建会话工厂
-AsyncSessionLocal = sessionmaker(
-    engine, class_=AsyncSession, expire_on_commit=False
+AsyncSessionRW = sessionmaker(
+    engine_rw, class_=AsyncSession, expire_on_commit=False
+)
+AsyncSessionRO = sessionmaker(
+    engine_ro, class_=AsyncSession, expire_on_commit=False
 )
 
-async def get_db():
-    """获取数据库会话"""
-    async with AsyncSessionLocal() as session:
+async def get_db_rw():
+    """获取读写数据库会话"""
+    async with AsyncSessionRW() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+async def get_db_ro():
+    """获取只读数据库会话"""
+    async with AsyncSessionRO() as session:
         try:
             yield session
         finally:
@@ -43,29 +104,81 @@ async def init_database():
         os.makedirs(DATABASE_DIR, exist_ok=True)
         
         # 创建所有表
-        async with engine.begin() as conn:
+        async with engine_rw.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(_migrate_schema)
         
         logger.info("数据库初始化成功")
         
         # 创建默认用户
         await create_default_user()
         
+        # 长连接进程启动时执行一次（0x10002：分析所有表，并限制每张表的扫描量）
+        await optimize_database("PRAGMA optimize=0x10002")
+        
     except Exception as e:
         logger.error(f"数据库初始化失败: {e}")
         raise
 
+def _migrate_schema(conn):
+    """为旧数据库补充新增的列和索引，并转换旧的文本UUID"""
+    session_columns = {column['name'] for column in inspect(conn).get_columns('sessions')}
+    if 'message_count' not in session_columns:
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "UPDATE sessions SET message_count = "
+            "(SELECT COUNT(*) FROM messages WHERE messages.session_id = sessions.id)"
+        ))
+        logger.info("已为sessions表添加message_count列")
+    
+    # create_all不会为已存在的表补建索引
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    # 已被ix_messages_session_created覆盖
+    conn.execute(text("DROP INDEX IF EXISTS ix_messages_session_id"))
+    
+    # 主键和引用它的外键分步转换，外键检查推迟到提交时进行。
+    # defer_foreign_keys只在事务内有效，而前面的DDL不会开启事务，所以先用SAVEPOINT开启
+    conn.execute(text("SAVEPOINT guid_migration"))
+    conn.execute(text("PRAGMA defer_foreign_keys=ON"))
+    
+    # 旧版本创建的默认用户id是随机UUID，而请求默认以user_id="default"写入，
+    # 按id冲突的upsert会撞上username的唯一约束，因此把它的id（及引用它的行）改为"default"
+    old_default_ids = conn.execute(text(
+        "SELECT id FROM users WHERE username = 'default' AND id <> 'default'"
+    )).scalars().all()
+    if old_default_ids:
+        params = [{"old": old_id} for old_id in old_default_ids]
+        for table in ("sessions", "request_logs"):
+            conn.execute(text(f"UPDATE {table} SET user_id = 'default' WHERE user_id = :old"), params)
+        conn.execute(text("UPDATE users SET id = 'default' WHERE id = :old"), params)
+        logger.info("已将默认用户的id迁移为default")
+    
+    for table, column in GUID_COLUMNS:
+        result = conn.execute(text(f"SELECT DISTINCT {column} FROM {table} WHERE typeof({column}) = 'text'"))
+        params = []
+        for value in result.scalars():
+            try:
+                params.append({"old": value, "new": uuid.UUID(value).bytes})
+            except ValueError:
+                continue
+        if params:
+            conn.execute(text(f"UPDATE {table} SET {column} = :new WHERE {column} = :old"), params)
+            logger.info(f"已将{table}.{column}的{len(params)}个UUID转换为BLOB")
+    conn.execute(text("RELEASE guid_migration"))
+
 async def create_default_user():
     """创建默认用户"""
     try:
-        async with AsyncSessionLocal() as session:
+        async with AsyncSessionRW() as session:
             # 检查是否已存在默认用户
-            from sqlalchemy import select
             result = await session.execute(select(User).where(User.username == "default"))
             existing_user = result.scalar_one_or_none()
             
             if not existing_user:
                 default_user = User(
+                    id="default",
                     username="default",
                     email="default@example.com",
                     api_key="default-api-key",
@@ -81,14 +194,23 @@ async def create_default_user():
         logger.error(f"创建默认用户失败: {e}")
         raise
 
+async def optimize_database(optimize_pragma: str = "PRAGMA optimize"):
+    """更新查询规划统计信息，并将WAL写回主库后截断"""
+    async with engine_rw.connect() as conn:
+        await conn.exec_driver_sql(optimize_pragma)
+        await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
 async def close_database():
     """关闭数据库连接"""
-    await engine.dispose()
+    await engine_ro.dispose()
+    await engine_rw.dispose()
     logger.info("数据库连接已关闭")
 
 def create_sync_engine():
     """创建同步引擎（用于测试或特殊情况）"""
-    return create_engine(SYNC_DATABASE_URL, echo=False)
+    sync_engine = create_engine(SYNC_DATABASE_URL, echo=False)
+    event.listen(sync_engine, "connect", _sqlite_pragma_listener(SQLITE_WRITER_PRAGMAS))
+    return sync_engine
 
 if __name__ == "__main__":
     # 直接运行此脚本时初始化数据库
@@ -1,19 +1,28 @@
 from fastapi import FastAPI, HTTPException, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse, ORJSONResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
+from collections import OrderedDict
 import httpx
+import orjson
 import os
-import json
 import time
+import asyncio
+import uuid
+import ipaddress
 from datetime import datetime
 import logging
-from sqlalchemy import select, and_, desc, func
+from sqlalchemy import select, and_, desc, func, update, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 # 导入数据库相关模块
-from database import get_db, init_database, close_database
+from database import (get_db_ro, get_db_rw, init_database, close_database, optimize_database,
+                      AsyncSessionRO, AsyncSessionRW)
 from models import User, Session, Message, RequestLog
 
 # Pydantic模型定义
@@ -63,7 +72,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Qwen API Gateway with Conversation Storage", version="2.0.0")
+app = FastAPI(title="Qwen API Gateway with Conversation Storage", version="2.0.0",
+              default_response_class=ORJSONResponse)
 
 # 允许跨域请求（方便本地开发）
 app.add_middleware(
@@ -77,21 +87,86 @@ app.add_middleware(
 # 应用启动和关闭事件
 @app.on_event("startup")
 async def startup_event():
-    """应用启动时初始化数据库"""
+    """应用启动时初始化数据库和vLLM连接池"""
     await init_database()
+    
+    # 复用到vLLM的长连接，避免每个请求重新建立TCP连接
+    app.state.http = httpx.AsyncClient(
+        base_url=VLLM_URL,
+        http2=True,
+        timeout=httpx.Timeout(120.0),
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=256)
+    )
+    
+    # 请求日志先入队，由后台任务批量写入数据库
+    app.state.log_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    app.state.log_flusher = asyncio.create_task(_log_flusher())
+    
+    # 访问日志同样先入队，由后台任务格式化后写入
+    app.state.audit_queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    app.state.audit_writer = asyncio.create_task(_audit_writer())
+    
+    # 定期维护数据库
+    app.state.maintenance = asyncio.create_task(_maintenance_loop())
     logger.info("应用启动完成，数据库已初始化")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """应用关闭时清理资源"""
+    app.state.maintenance.cancel()
+    # 通知日志任务写完队列中剩余的日志后退出
+    await app.state.log_queue.put(None)
+    await app.state.log_flusher
+    await app.state.audit_queue.put(None)
+    await app.state.audit_writer
+    await app.state.http.aclose()
     await close_database()
     logger.info("应用已关闭，数据库连接已清理")
 
+class TTLCache:
+    """进程内的单值缓存，超过ttl秒后失效"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.value = None
+        self.expires_at = 0.0
+        self._lock = asyncio.Lock()
+    
+    def get(self):
+        if time.monotonic() < self.expires_at:
+            return self.value
+        return None
+    
+    def set(self, value):
+        self.value = value
+        self.expires_at = time.monotonic() + self.ttl
+    
+    async def get_or_load(self, loader):
+        """缓存失效时只由一个协程调用loader刷新，其余协程等待并复用结果"""
+        value = self.get()
+        if value is not None:
+            return value
+        async with self._lock:
+            value = self.get()
+            if value is None:
+                value = await loader()
+                self.set(value)
+        return value
+
 # 配置
 API_KEY = os.getenv('API_KEY', 'default_key')
 VLLM_URL = os.getenv('VLLM_URL', 'http://localhost:8001')
 ALLOWED_IPS = os.getenv('ALLOWED_IPS', '').split(',') if os.getenv('ALLOWED_IPS') else []
 LOG_REQUESTS = os.getenv('LOG_REQUESTS', 'true').lower() == 'true'
+# 每个worker进程各自持有缓存、日志队列和数据库连接池
+WORKERS = int(os.getenv('WORKERS', '1'))
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 500
+LOG_FLUSH_INTERVAL = 0.2  # 秒
+KNOWN_USERS_CACHE_SIZE = 1024
+STATS_CACHE_TTL = 10  # 秒
+MAINTENANCE_INTERVAL = 3600  # 秒
+MODELS_CACHE_TTL = 30  # 秒
+HEALTH_CACHE_TTL = 2  # 秒
 
 security = HTTPBearer()
 
@@ -99,6 +174,17 @@ class SimpleAuth:
     def __init__(self):
         self.api_key = API_KEY
         self.allowed_ips = [ip.strip() for ip in ALLOWED_IPS if ip.strip()]
+        
+        # 启动时预先解析：单个IP用集合查找，CIDR解析为网络对象
+        self._exact_ips = frozenset(ip for ip in self.allowed_ips if '/' not in ip)
+        networks = []
+        for allowed_ip in self.allowed_ips:
+            if '/' in allowed_ip:
+                try:
+                    networks.append(ipaddress.ip_network(allowed_ip, strict=False))
+                except ValueError:
+                    logger.warning(f"忽略无效的CIDR配置: {allowed_ip}")
+        self._networks = tuple(networks)
     
     def verify_api_key(self, token: str) -> bool:
         """验证API密钥"""
@@ -109,32 +195,58 @@ class SimpleAuth:
         if not self.allowed_ips:
             return True  # 如果没有设置IP限制，则允许所有IP
         
-        for allowed_ip in self.allowed_ips:
-            if '/' in allowed_ip:  # CIDR格式
-                import ipaddress
-                try:
-                    if ipaddress.ip_address(ip) in ipaddress.ip_network(allowed_ip, strict=False):
-                        return True
-                except:
-                    continue
-            else:  # 单个IP
-                if ip == allowed_ip:
-                    return True
-        return False
+        if ip in self._exact_ips:
+            return True
+        
+        if not self._networks:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self._networks)
     
     def log_request(self, ip: str, endpoint: str, status: str, details: dict = None):
-        """记录请求日志"""
+        """记录请求日志（只入队，由_audit_writer格式化并写入）"""
         if LOG_REQUESTS:
-            log_data = {
-                'timestamp': datetime.now().isoformat(),
-                'ip': ip,
-                'endpoint': endpoint,
-                'status': status,
-                'details': details or {}
-            }
-            logger.info(f"REQUEST: {json.dumps(log_data)}")
+            try:
+                app.state.audit_queue.put_nowait((time.time(), ip, endpoint, status, details))
+            except asyncio.QueueFull:
+                pass
+
+async def _audit_writer():
+    """后台任务：格式化并写入访问日志，收到None时退出"""
+    queue = app.state.audit_queue
+    while True:
+        entry = await queue.get()
+        if entry is None:
+            break
+        
+        timestamp, ip, endpoint, status, details = entry
+        log_data = {
+            'timestamp': datetime.fromtimestamp(timestamp).isoformat(),
+            'ip': ip,
+            'endpoint': endpoint,
+            'status': status,
+            'details': details or {}
+        }
+        logger.info(f"REQUEST: {orjson.dumps(log_data).decode()}")
 
 auth = SimpleAuth()
+_stats_cache = TTLCache(STATS_CACHE_TTL)
+_models_cache = TTLCache(MODELS_CACHE_TTL)
+_health_cache = TTLCache(HEALTH_CACHE_TTL)
+
+# 认证失败只在进程内按UTC日期计数，不写request_logs，避免未认证的客户端无限撑大数据库
+# （多worker时各进程分别计数）
+_auth_failures: Dict[str, int] = {}
+
+def count_auth_failure():
+    """累加今天的认证失败次数，跨天时丢弃旧计数"""
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    if today not in _auth_failures:
+        _auth_failures.clear()
+    _auth_failures[today] = _auth_failures.get(today, 0) + 1
 
 async def verify_token(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """验证请求认证"""
@@ -143,12 +255,14 @@ async def verify_token(request: Request, credentials: HTTPAuthorizationCredentia
     # 检查IP限制
     if not auth.check_ip_allowed(client_ip):
         auth.log_request(client_ip, request.url.path, "IP_BLOCKED")
+        count_auth_failure()
         raise HTTPException(status_code=403, detail="IP not allowed")
     
     # 验证API密钥
     if not auth.verify_api_key(credentials.credentials):
         auth.log_request(client_ip, request.url.path, "AUTH_FAILED", 
                         {'reason': 'Invalid API key'})
+        count_auth_failure()
         raise HTTPException(status_code=401, detail="Invalid API key")
     
     return client_ip
@@ -177,12 +291,14 @@ async def root():
 @app.get("/health")
 async def health_check():
     """健康检查"""
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{VLLM_URL}/health", timeout=5.0)
-            vllm_status = "healthy" if response.status_code == 200 else "unhealthy"
-    except:
-        vllm_status = "unhealthy"
+    async def probe_vllm():
+        try:
+            response = await app.state.http.get("/health", timeout=5.0)
+            return "healthy" if response.status_code == 200 else "unhealthy"
+        except:
+            return "unhealthy"
+    
+    vllm_status = await _health_cache.get_or_load(probe_vllm)
     
     return {
         "status": "healthy",
@@ -195,10 +311,13 @@ async def list_models(client_ip: str = Depends(verify_token)):
     """获取可用模型列表"""
     auth.log_request(client_ip, "/v1/models", "SUCCESS")
     
+    async def fetch_models():
+        response = await app.state.http.get("/v1/models", timeout=10.0)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+    
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{VLLM_URL}/v1/models", timeout=10.0)
-            return response.json()
+        return await _models_cache.get_or_load(fetch_models)
     except Exception as e:
         auth.log_request(client_ip, "/v1/models", "ERROR", {'error': str(e)})
         raise HTTPException(status_code=500, detail="Failed to get models")
@@ -206,84 +325,87 @@ async def list_models(client_ip: str = Depends(verify_token)):
 @app.post("/v1/chat/completions")
 async def chat_completions(request: Request, chat_request: ChatRequest, 
                           client_ip: str = Depends(verify_token),
-                          db: AsyncSession = Depends(get_db)):
+                          db: AsyncSession = Depends(get_db_rw)):
     """聊天完成接口（带对话存储）"""
     start_time = time.time()
     
     try:
-        # 获取或创建用户
-        user = await get_or_create_user(db, chat_request.user_id)
-        
-        # 获取或创建会话
-        session = None
-        if chat_request.session_id:
-            session = await get_session_by_id(db, chat_request.session_id, user.id)
-        
-        if not session:
-            # 创建新会话
-            session = await create_new_session(db, user.id, chat_request.model, 
-                                             title=f"对话 {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+        # 用户和会话在同一事务中写入
+        async with db.begin():
+            # 获取或创建用户
+            user_id = await get_or_create_user(db, chat_request.user_id)
+            
+            # 获取或创建会话
+            session = None
+            if chat_request.session_id:
+                session = await get_session_by_id(db, chat_request.session_id, user_id)
+            
+            if not session:
+                # 创建新会话
+                session = await create_new_session(db, user_id, chat_request.model, 
+                                                 title=f"对话 {datetime.now().strftime('%Y-%m-%d %H:%M')}")
         
-        # 存储用户消息
-        user_message = None
+        # 用户消息先不写库，与助手回复一起批量插入
+        message_rows = []
         if chat_request.messages:
             last_message = chat_request.messages[-1]
             if last_message.role == "user":
-                user_message = await store_message(db, session.id, "user", last_message.content)
+                message_rows.append(build_message_row(session.id, "user", last_message.content))
         
         # 记录请求开始
         auth.log_request(client_ip, "/v1/chat/completions", "START", {
             'model': chat_request.model,
             'session_id': session.id,
-            'user_id': user.id,
+            'user_id': user_id,
             'messages_count': len(chat_request.messages)
         })
         
-        # 准备发送给vLLM的请求
-        vllm_request = {
-            "model": chat_request.model,
-            "messages": [msg.dict() for msg in chat_request.messages],
-            "temperature": chat_request.temperature,
-            "stream": chat_request.stream
-        }
+        # 准备发送给vLLM的请求（去掉网关自用的字段和未设置的参数）
+        vllm_request = chat_request.model_dump(exclude={'session_id', 'user_id'}, exclude_none=True)
+        # 与原实现一致：max_tokens为0时不传，由vLLM使用默认长度
+        if not vllm_request.get('max_tokens'):
+            vllm_request.pop('max_tokens', None)
         
-        if chat_request.max_tokens:
-            vllm_request["max_tokens"] = chat_request.max_tokens
+        # 流式请求：边生成边转发，结束后再存储回复
+        if chat_request.stream:
+            return await stream_chat_completion(request, vllm_request, session.id, user_id,
+                                                message_rows, client_ip, start_time)
         
         # 转发请求到vLLM
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{VLLM_URL}/v1/chat/completions",
-                json=vllm_request,
-                timeout=120.0
+        response = await app.state.http.post("/v1/chat/completions", json=vllm_request)
+        
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"vLLM error: {response.text}"
             )
-            
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"vLLM error: {response.text}"
-                )
-            
-            response_data = response.json()
         
-        # 存储助手回复
-        assistant_message = None
+        response_data = orjson.loads(response.content)
+        
+        # 助手回复
         if response_data.get('choices') and len(response_data['choices']) > 0:
             assistant_content = response_data['choices'][0]['message']['content']
-            assistant_message = await store_message(db, session.id, "assistant", assistant_content,
-                                                  token_count=response_data.get('usage', {}).get('completion_tokens', 0))
+            message_rows.append(build_message_row(session.id, "assistant", assistant_content,
+                                                  token_count=response_data.get('usage', {}).get('completion_tokens', 0)))
         
-        # 更新会话时间
-        await update_session_timestamp(db, session.id)
+        # 用户消息、助手回复和会话更新在同一事务中写入
+        async with db.begin():
+            await store_messages(db, session.id, message_rows)
         
         # 记录请求日志到数据库
-        await log_request_to_db(db, user.id, session.id, "/v1/chat/completions", "POST", 
-                               client_ip, request.headers.get("user-agent"), 
-                               json.dumps(vllm_request), 200, int((time.time() - start_time) * 1000))
-        
-        # 在响应中添加会话信息
-        response_data['session_id'] = session.id
-        response_data['user_id'] = user.id
+        log_request_to_db(user_id, session.id, "/v1/chat/completions", "POST", 
+                          client_ip, request.headers.get("user-agent"), 
+                          orjson.dumps(vllm_request).decode(), 200, int((time.time() - start_time) * 1000))
+        
+        # 在响应中添加会话信息：直接拼接到vLLM返回的原始字节末尾，避免重新序列化整个响应
+        body = response.content.rstrip()
+        if response_data and isinstance(response_data, dict) and body.endswith(b'}'):
+            body = (body[:-1] + b',"session_id":' + orjson.dumps(session.id)
+                    + b',"user_id":' + orjson.dumps(user_id) + b'}')
+        else:
+            response_data['session_id'] = session.id
+            response_data['user_id'] = user_id
+            body = orjson.dumps(response_data)
         
         # 记录成功响应
         response_time = time.time() - start_time
@@ -294,9 +416,14 @@ async def chat_completions(request: Request, chat_request: ChatRequest,
             'session_id': session.id
         })
         
-        return response_data
+        # user_id来自客户端且可能含非latin-1字符，只在body中返回；响应头只放ASCII的会话UUID
+        return Response(content=body, media_type="application/json",
+                        headers={"X-Session-Id": session.id})
         
-    except HTTPException:
+    except HTTPException as e:
+        log_request_to_db(chat_request.user_id, None, "/v1/chat/completions", "POST",
+                          client_ip, request.headers.get("user-agent"), None,
+                          e.status_code, int((time.time() - start_time) * 1000))
         raise
     except Exception as e:
         response_time = time.time() - start_time
@@ -304,26 +431,133 @@ async def chat_completions(request: Request, chat_request: ChatRequest,
             'error': str(e),
             'response_time': round(response_time, 3)
         })
+        log_request_to_db(chat_request.user_id, None, "/v1/chat/completions", "POST",
+                          client_ip, request.headers.get("user-agent"), None,
+                          500, int(response_time * 1000))
         raise HTTPException(status_code=500, detail=f"Internal error: {str(e)}")
 
+async def stream_chat_completion(request: Request, vllm_request: dict, session_id: str, user_id: str,
+                                 message_rows: List[dict], client_ip: str, start_time: float) -> StreamingResponse:
+    """流式转发vLLM的SSE响应，流结束后在后台存储助手回复"""
+    upstream = await app.state.http.send(
+        app.state.http.build_request("POST", "/v1/chat/completions", json=vllm_request),
+        stream=True
+    )
+    
+    if upstream.status_code != 200:
+        await upstream.aread()
+        await upstream.aclose()
+        raise HTTPException(
+            status_code=upstream.status_code,
+            detail=f"vLLM error: {upstream.text}"
+        )
+    
+    content_parts = []
+    usage = {}
+    
+    def collect(line: bytes):
+        """从SSE数据行中提取增量内容和用量"""
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            return
+        payload = line[5:].strip()
+        if not payload or payload == b"[DONE]":
+            return
+        try:
+            data = orjson.loads(payload)
+        except ValueError:
+            return
+        if data.get('choices'):
+            content = data['choices'][0].get('delta', {}).get('content')
+            if content:
+                content_parts.append(content)
+        if data.get('usage'):
+            usage.update(data['usage'])
+    
+    async def relay():
+        buffer = b""
+        try:
+            async for chunk in upstream.aiter_bytes():
+                yield chunk
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    collect(line)
+            collect(buffer)
+        finally:
+            await upstream.aclose()
+    
+    async def save_reply():
+        """存储流式生成的助手回复"""
+        try:
+            message_rows.append(build_message_row(session_id, "assistant", "".join(content_parts),
+                                                  token_count=usage.get('completion_tokens', 0)))
+            async with AsyncSessionRW() as db:
+                async with db.begin():
+                    await store_messages(db, session_id, message_rows)
+            
+            log_request_to_db(user_id, session_id, "/v1/chat/completions", "POST", 
+                              client_ip, request.headers.get("user-agent"), 
+                              orjson.dumps(vllm_request).decode(), 200, int((time.time() - start_time) * 1000))
+            
+            auth.log_request(client_ip, "/v1/chat/completions", "SUCCESS", {
+                'response_time': round(time.time() - start_time, 3),
+                'tokens_used': usage.get('total_tokens', 0),
+                'model': vllm_request.get('model'),
+                'session_id': session_id,
+                'stream': True
+            })
+        except Exception as e:
+            auth.log_request(client_ip, "/v1/chat/completions", "ERROR", {
+                'error': str(e),
+                'session_id': session_id,
+                'stream': True
+            })
+    
+    # 流式响应无法在body中附加会话信息，通过响应头返回会话ID（user_id可能含非latin-1字符，不放入响应头）
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers={"X-Session-Id": session_id},
+        background=BackgroundTask(save_reply)
+    )
+
+async def _maintenance_loop():
+    """后台任务：每隔MAINTENANCE_INTERVAL执行PRAGMA optimize和WAL检查点"""
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        try:
+            await optimize_database()
+            logger.info("数据库维护完成")
+        except Exception as e:
+            logger.error(f"数据库维护失败: {e}")
+
 # 数据库辅助函数
-async def get_or_create_user(db: AsyncSession, user_id: str) -> User:
-    """获取或创建用户"""
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
+# 已确认存在于数据库中的用户ID（LRU），命中时跳过写库
+_known_user_ids = OrderedDict()
+
+async def get_or_create_user(db: AsyncSession, user_id: str) -> str:
+    """获取或创建用户，返回用户ID"""
+    if user_id in _known_user_ids:
+        _known_user_ids.move_to_end(user_id)
+        return user_id
+    
+    result = await db.execute(
+        sqlite_insert(User)
+        .values(id=user_id, username=user_id)
+        .on_conflict_do_nothing(index_elements=['id'])
+    )
     
-    if not user:
-        user = User(id=user_id)
-        db.add(user)
-        await db.commit()
-        await db.refresh(user)
+    # 只缓存已提交的用户：本次新插入的行要等下一次请求确认后再缓存，以免事务回滚后缓存失效
+    if result.rowcount == 0:
+        _known_user_ids[user_id] = True
+        if len(_known_user_ids) > KNOWN_USERS_CACHE_SIZE:
+            _known_user_ids.popitem(last=False)
     
-    return user
+    return user_id
 
 async def create_new_session(db: AsyncSession, user_id: str, model_name: str, title: str = None) -> Session:
     """创建新会话"""
-    import uuid
-    
     session = Session(
         id=str(uuid.uuid4()),
         user_id=user_id,
@@ -332,8 +566,7 @@ async def create_new_session(db: AsyncSession, user_id: str, model_name: str, ti
     )
     
     db.add(session)
-    await db.commit()
-    await db.refresh(session)
+    await db.flush()
     
     return session
 
@@ -346,72 +579,117 @@ async def get_session_by_id(db: AsyncSession, session_id: str, user_id: str) ->
     )
     return result.scalar_one_or_none()
 
-async def store_message(db: AsyncSession, session_id: str, role: str, content: str, token_count: int = 0) -> Message:
-    """存储消息"""
-    import uuid
+def build_message_row(session_id: str, role: str, content: str, token_count: int = 0) -> dict:
+    """构造一条待插入的消息（预先分配ID和创建时间）"""
+    return {
+        'id': uuid.uuid4(),  # GUID直接绑定UUID的16字节
+        'session_id': session_id,
+        'role': role,
+        'content': content,
+        'token_count': token_count,
+        'created_at': datetime.utcnow()
+    }
+
+async def store_messages(db: AsyncSession, session_id: str, rows: List[dict]):
+    """批量存储消息，并在同一条UPDATE中更新会话时间戳和消息数"""
+    if rows:
+        await db.execute(insert(Message), rows)
     
-    message = Message(
-        id=str(uuid.uuid4()),
-        session_id=session_id,
-        role=role,
-        content=content,
-        token_count=token_count
+    await db.execute(
+        update(Session)
+        .where(Session.id == session_id)
+        .values(updated_at=datetime.now(), message_count=Session.message_count + len(rows))
     )
-    
-    db.add(message)
-    await db.commit()
-    await db.refresh(message)
-    
-    return message
 
-async def update_session_timestamp(db: AsyncSession, session_id: str):
-    """更新会话时间戳"""
-    result = await db.execute(select(Session).where(Session.id == session_id))
-    session = result.scalar_one_or_none()
-    
-    if session:
-        session.updated_at = datetime.now()
-        await db.commit()
+def log_request_to_db(user_id: str, session_id: str, endpoint: str, 
+                      method: str, ip_address: str, user_agent: str, 
+                      request_data: str, response_status: int, response_time_ms: int):
+    """将请求日志放入队列，由后台任务批量写入数据库"""
+    try:
+        app.state.log_queue.put_nowait({
+            'user_id': user_id,
+            'session_id': session_id,
+            'endpoint': endpoint,
+            'method': method,
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'request_data': request_data,
+            'response_status': response_status,
+            'response_time_ms': response_time_ms
+        })
+    except asyncio.QueueFull:
+        logger.warning("请求日志队列已满，丢弃一条日志")
 
-async def log_request_to_db(db: AsyncSession, user_id: str, session_id: str, endpoint: str, 
-                           method: str, ip_address: str, user_agent: str, 
-                           request_data: str, response_status: int, response_time_ms: int):
-    """记录请求到数据库"""
-    import uuid
-    
-    log_entry = RequestLog(
-        id=str(uuid.uuid4()),
-        user_id=user_id,
-        session_id=session_id,
-        endpoint=endpoint,
-        method=method,
-        ip_address=ip_address,
-        user_agent=user_agent,
-        request_data=request_data,
-        response_status=response_status,
-        response_time_ms=response_time_ms
-    )
+async def _flush_request_logs(rows: List[dict]):
+    """批量插入请求日志"""
+    try:
+        async with AsyncSessionRW() as db:
+            try:
+                await db.execute(insert(RequestLog), rows)
+                await db.commit()
+            except IntegrityError:
+                # 会话可能在日志入库前已被删除（失败请求的用户也可能未创建），
+                # 与delete_session一致地解除引用后重试
+                await db.rollback()
+                for column, model in (('session_id', Session), ('user_id', User)):
+                    ids = {row[column] for row in rows if row[column]}
+                    result = await db.execute(select(model.id).where(model.id.in_(ids)))
+                    existing_ids = set(result.scalars().all())
+                    for row in rows:
+                        if row[column] not in existing_ids:
+                            row[column] = None
+                await db.execute(insert(RequestLog), rows)
+                await db.commit()
+    except Exception as e:
+        logger.error(f"请求日志写入失败（{len(rows)}条）: {e}")
+
+async def _log_flusher():
+    """后台任务：每攒够LOG_BATCH_SIZE条或等待LOG_FLUSH_INTERVAL后写入一批日志，收到None时退出"""
+    queue = app.state.log_queue
+    loop = asyncio.get_running_loop()
+    running = True
     
-    db.add(log_entry)
-    await db.commit()
+    while running:
+        row = await queue.get()
+        if row is None:
+            break
+        
+        rows = [row]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                running = False
+                break
+            rows.append(row)
+        
+        await _flush_request_logs(rows)
 
 # 会话管理API
 @app.post("/v1/sessions", response_model=SessionResponse)
 async def create_session(session_data: SessionCreate, 
                         client_ip: str = Depends(verify_token),
-                        db: AsyncSession = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db_rw)):
     """创建新会话"""
     try:
-        # 获取或创建用户
-        user = await get_or_create_user(db, session_data.user_id)
-        
-        # 创建会话
-        session = await create_new_session(db, user.id, session_data.model, session_data.title)
+        async with db.begin():
+            # 获取或创建用户
+            user_id = await get_or_create_user(db, session_data.user_id)
+            
+            # 创建会话
+            session = await create_new_session(db, user_id, session_data.model_name, session_data.title)
         
         return SessionResponse(
             id=session.id,
             title=session.title,
-            model=session.model_name,
+            model_name=session.model_name,
+            system_prompt=session.system_prompt,
             created_at=session.created_at,
             updated_at=session.updated_at,
             message_count=0
@@ -422,30 +700,26 @@ async def create_session(session_data: SessionCreate,
 @app.get("/v1/sessions", response_model=List[SessionResponse])
 async def list_sessions(user_id: str = "default", 
                        client_ip: str = Depends(verify_token),
-                       db: AsyncSession = Depends(get_db)):
+                       db: AsyncSession = Depends(get_db_ro)):
     """获取用户的所有会话"""
     try:
-         # 获取用户
-        user = await get_or_create_user(db, user_id)
-        
         # 查询会话
         result = await db.execute(
-            select(Session, func.count(Message.id).label('message_count'))
-            .outerjoin(Message, Session.id == Message.session_id)
-            .where(Session.user_id == user.id)
-            .group_by(Session.id)
+            select(Session)
+            .where(Session.user_id == user_id)
             .order_by(desc(Session.updated_at))
         )
         
         sessions = []
-        for session, message_count in result.all():
+        for session in result.scalars().all():
             sessions.append(SessionResponse(
                  id=session.id,
                  title=session.title,
-                 model=session.model_name,
+                 model_name=session.model_name,
+                 system_prompt=session.system_prompt,
                  created_at=session.created_at,
                  updated_at=session.updated_at,
-                 message_count=message_count or 0
+                 message_count=session.message_count
              ))
         
         return sessions
@@ -455,28 +729,22 @@ async def list_sessions(user_id: str = "default",
 @app.get("/v1/sessions/{session_id}", response_model=SessionResponse)
 async def get_session(session_id: str, user_id: str = "default",
                      client_ip: str = Depends(verify_token),
-                     db: AsyncSession = Depends(get_db)):
+                     db: AsyncSession = Depends(get_db_ro)):
     """获取特定会话信息"""
     try:
-         user = await get_or_create_user(db, user_id)
-        session = await get_session_by_id(db, session_id, user.id)
+        session = await get_session_by_id(db, session_id, user_id)
         
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # 获取消息数量
-        result = await db.execute(
-            select(func.count(Message.id)).where(Message.session_id == session.id)
-        )
-        message_count = result.scalar() or 0
-        
         return SessionResponse(
              id=session.id,
              title=session.title,
-             model=session.model_name,
+             model_name=session.model_name,
+             system_prompt=session.system_prompt,
              created_at=session.created_at,
              updated_at=session.updated_at,
-             message_count=message_count
+             message_count=session.message_count
          )
     except HTTPException:
         raise
@@ -486,47 +754,56 @@ async def get_session(session_id: str, user_id: str = "default",
 @app.delete("/v1/sessions/{session_id}")
 async def delete_session(session_id: str, user_id: str = "default",
                         client_ip: str = Depends(verify_token),
-                        db: AsyncSession = Depends(get_db)):
+                        db: AsyncSession = Depends(get_db_rw)):
     """删除会话"""
     try:
-        user = await get_or_create_user(db, user_id)
-        session = await get_session_by_id(db, session_id, user.id)
-        
-        if not session:
-            raise HTTPException(status_code=404, detail="Session not found")
-        
-        # 删除会话（级联删除消息）
-        await db.delete(session)
-        await db.commit()
+        async with db.begin():
+            session = await get_session_by_id(db, session_id, user_id)
+            
+            if not session:
+                raise HTTPException(status_code=404, detail="Session not found")
+            
+            # 解除请求日志对会话的引用（外键约束已开启）
+            await db.execute(
+                update(RequestLog).where(RequestLog.session_id == session.id).values(session_id=None)
+            )
+            
+            # 删除会话（级联删除消息）
+            await db.delete(session)
         
         return {"message": "Session deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
-        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to delete session: {str(e)}")
 
 @app.get("/v1/sessions/{session_id}/messages", response_model=List[MessageResponse])
 async def get_session_messages(session_id: str, user_id: str = "default",
                               client_ip: str = Depends(verify_token),
-                              db: AsyncSession = Depends(get_db)):
+                              db: AsyncSession = Depends(get_db_ro)):
     """获取会话的所有消息"""
+    async def fetch_messages():
+        # 使用独立的只读会话，才能与会话查询并发执行
+        async with AsyncSessionRO() as message_db:
+            result = await message_db.execute(
+                select(Message)
+                .where(Message.session_id == session_id)
+                .order_by(Message.created_at)
+            )
+            return result.scalars().all()
+    
     try:
-        user = await get_or_create_user(db, user_id)
-        session = await get_session_by_id(db, session_id, user.id)
+        # 会话归属校验和消息查询并发执行，会话不存在时丢弃消息结果
+        session, rows = await asyncio.gather(
+            get_session_by_id(db, session_id, user_id),
+            fetch_messages()
+        )
         
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
         
-        # 查询消息
-        result = await db.execute(
-            select(Message)
-            .where(Message.session_id == session.id)
-            .order_by(Message.created_at)
-        )
-        
         messages = []
-        for message in result.scalars().all():
+        for message in rows:
             messages.append(MessageResponse(
                 id=message.id,
                 role=message.role,
@@ -542,37 +819,43 @@ async def get_session_messages(session_id: str, user_id: str = "default",
         raise HTTPException(status_code=500, detail=f"Failed to get messages: {str(e)}")
 
 @app.get("/stats")
-async def get_stats(client_ip: str = Depends(verify_token)):
+async def get_stats(client_ip: str = Depends(verify_token),
+                    db: AsyncSession = Depends(get_db_ro)):
     """获取简单的使用统计"""
     try:
-        # 读取今天的日志统计
-        import re
-        from collections import defaultdict
+        cached = _stats_cache.get()
+        if cached is not None:
+            return cached
+        
+        # 按状态码统计今天（UTC，与created_at一致）的请求
+        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        result = await db.execute(
+            select(RequestLog.response_status, func.count())
+            .where(RequestLog.created_at >= today_start)
+            .group_by(RequestLog.response_status)
+        )
         
-        stats = defaultdict(int)
-        today = datetime.now().strftime('%Y-%m-%d')
+        today = today_start.strftime('%Y-%m-%d')
+        stats = {'successful_requests': 0, 'failed_requests': 0,
+                 'auth_failures': _auth_failures.get(today, 0)}
+        for status, count in result.all():
+            if status is not None and status < 400:
+                stats['successful_requests'] += count
+            else:
+                stats['failed_requests'] += count
         
-        try:
-            with open('/app/logs/access.log', 'r') as f:
-                for line in f:
-                    if today in line and 'REQUEST:' in line:
-                        if '"status": "SUCCESS"' in line:
-                            stats['successful_requests'] += 1
-                        elif '"status": "ERROR"' in line:
-                            stats['failed_requests'] += 1
-                        elif '"status": "AUTH_FAILED"' in line:
-                            stats['auth_failures'] += 1
-        except FileNotFoundError:
-            pass
-        
-        return {
+        response = {
             'date': today,
-            'stats': dict(stats),
+            'stats': stats,
             'total_requests': sum(stats.values())
         }
+        _stats_cache.set(response)
+        return response
     except Exception as e:
         return {'error': str(e)}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=3000)
\ No newline at end of file
+    # uvloop事件循环和httptools解析器（均由uvicorn[standard]提供）
+    uvicorn.run("index:app", host="0.0.0.0", port=3000,
+                loop="uvloop", http="httptools", workers=WORKERS)
\ No newline at end of file
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Index, LargeBinary
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -6,6 +7,27 @@ import uuid
 
 Base = declarative_base()
 
+class GUID(TypeDecorator):
+    """以16字节BLOB存储UUID，Python侧仍使用字符串"""
+    impl = LargeBinary(16)
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        if isinstance(value, uuid.UUID):
+            return value.bytes
+        try:
+            return uuid.UUID(value).bytes
+        except ValueError:
+            # 非法ID（如客户端传入的错误session_id）按原始字节绑定，查询时自然匹配不到
+            return value.encode()
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return str(uuid.UUID(bytes=value))
+
 class User(Base):
     """用户表"""
     __tablename__ = "users"
@@ -25,12 +47,13 @@ class Session(Base):
     """会话表"""
     __tablename__ = "sessions"
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
     user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
     title = Column(String(200), nullable=True)
     model_name = Column(String(100), default="qwen2.5-7b")
     system_prompt = Column(Text, nullable=True)
     is_active = Column(Boolean, default=True)
+    message_count = Column(Integer, default=0, nullable=False)  # 由store_message维护
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -41,9 +64,13 @@ class Session(Base):
 class Message(Base):
     """消息表"""
     __tablename__ = "messages"
+    # 按会话读取消息时直接按索引顺序返回，无需再排序
+    __table_args__ = (
+        Index("ix_messages_session_created", "session_id", "created_at"),
+    )
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    session_id = Column(String, ForeignKey("sessions.id"), nullable=False, index=True)
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
+    session_id = Column(GUID, ForeignKey("sessions.id"), nullable=False)
     role = Column(String(20), nullable=False)  # user, assistant, system
     content = Column(Text, nullable=False)
     token_count = Column(Integer, default=0)
@@ -55,10 +82,14 @@ class Message(Base):
 class RequestLog(Base):
     """请求日志表"""
     __tablename__ = "request_logs"
+    # 覆盖/stats按日期统计各状态码数量的查询
+    __table_args__ = (
+        Index("ix_request_logs_created_status", "created_at", "response_status"),
+    )
     
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
     user_id = Column(String, ForeignKey("users.id"), nullable=True, index=True)
-    session_id = Column(String, ForeignKey("sessions.id"), nullable=True, index=True)
+    session_id = Column(GUID, ForeignKey("sessions.id"), nullable=True, index=True)
     endpoint = Column(String(100), nullable=False)
     method = Column(String(10), nullable=False)
     ip_address = Column(String(45), nullable=True)
@@ -4,42 +4,143 @@
 使用内置库测试核心API逻辑
 """
 
+import asyncio
 import json
 import sqlite3
 import os
 import sys
-from pathlib import Path
+import threading
+from functools import lru_cache
 from datetime import datetime
 
 # 添加当前目录到Python路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# 数据库路径和SQLite连接参数与test_basic.py建库时一致
+from test_basic import SQLITE_PRAGMAS, DB_PATH, DB_PATH_STR
+
+# 测试用SQL语句（固定为模块级常量，配合连接的语句缓存避免重复编译）
+SQL_GET_USER = "SELECT id, username FROM users WHERE api_key = ?"
+SQL_INSERT_SESSION = """
+    INSERT INTO sessions (user_id, title, model) 
+    VALUES (?, ?, ?)
+"""
+SQL_LIST_SESSIONS = """
+    SELECT id, title, model 
+    FROM sessions 
+    WHERE user_id = ? 
+    ORDER BY updated_at DESC
+"""
+SQL_INSERT_MESSAGE = """
+    INSERT INTO messages (session_id, role, content) 
+    VALUES (?, ?, ?)
+"""
+SQL_LIST_MESSAGES = """
+    SELECT role, content 
+    FROM messages 
+    WHERE session_id = ? 
+    ORDER BY created_at ASC
+"""
+SQL_INSERT_REQUEST_LOG = """
+    INSERT INTO request_logs (user_id, endpoint, method, status_code, response_time) 
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_REQUEST_STATS = """
+    SELECT COUNT(*) as total_requests,
+           AVG(response_time) as avg_response_time,
+           SUM(status_code = 200) as successful_requests
+    FROM request_logs 
+    WHERE user_id = ?
+"""
+# 只统计本次运行创建的会话（:session_ids为JSON数组）及其消息
+SQL_INTEGRITY_COUNTS = """
+    SELECT (SELECT COUNT(*) FROM sessions s JOIN users u ON s.user_id = u.id
+            WHERE s.id IN (SELECT value FROM json_each(:session_ids))) as session_user_joins,
+           (SELECT COUNT(*) FROM messages m JOIN sessions s ON m.session_id = s.id
+            WHERE m.session_id IN (SELECT value FROM json_each(:session_ids))) as message_session_joins
+"""
+
+def _open_connection():
+    """打开一个测试数据库连接并应用PRAGMA"""
+    conn = sqlite3.connect(DB_PATH_STR, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+# 用户查询专用的连接（text_factory=bytes，不与测试共用）
+_auth_conn = None
+
+def _get_auth_conn():
+    """返回用户查询专用的连接，首次调用时打开"""
+    global _auth_conn
+    if _auth_conn is None:
+        _auth_conn = _open_connection()
+        _auth_conn.text_factory = bytes
+    return _auth_conn
+
+def _close_auth_conn():
+    """清空用户查询缓存并关闭其连接"""
+    global _auth_conn
+    _lookup_user.cache_clear()
+    if _auth_conn is not None:
+        _auth_conn.close()
+        _auth_conn = None
+
+@lru_cache(maxsize=4096)
+def _lookup_user(api_key):
+    """按api_key查询用户，返回(id, username)或None；结果按api_key缓存，写users表后需调用cache_clear"""
+    # 查询不解码TEXT列，用户名在填充缓存时解码一次
+    user = _get_auth_conn().execute(SQL_GET_USER, (api_key,)).fetchone()
+    return (user['id'], user['username'].decode()) if user else None
+
 class SimpleAPITest:
-    def __init__(self):
-        self.db_path = Path("../volume/database/conversations.db")
+    def __init__(self, verbose=False):
+        self.verbose = verbose  # 为True时写入后再查询并逐行打印会话和消息列表
+        self._conn = None
+        # 并发任务在工作线程中使用各自的连接和输出缓冲
+        self._local = threading.local()
+        # 本次运行中创建的数据，供数据完整性测试核对
+        self._created_session_ids = []
+        self._created_message_count = 0
         
     def get_db_connection(self):
-        """获取数据库连接"""
-        return sqlite3.connect(str(self.db_path))
+        """获取数据库连接（主线程首次调用时创建，之后各测试复用同一连接；并发任务使用自己线程的连接）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        if self._conn is None:
+            self._conn = _open_connection()
+        return self._conn
+    
+    def _print(self, text=""):
+        """输出测试信息；并发任务中先写入缓冲，由主线程按顺序输出"""
+        output = getattr(self._local, 'output', None)
+        if output is None:
+            print(text)
+        else:
+            output.append(text + "\n")
+    
+    def close(self):
+        """关闭数据库连接"""
+        _close_auth_conn()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
     
     def test_user_management(self):
         """测试用户管理功能"""
         print("测试用户管理功能...")
         
-        conn = self.get_db_connection()
-        cursor = conn.cursor()
-        
         # 测试获取用户
-        cursor.execute("SELECT * FROM users WHERE api_key = ?", ("test-api-key-12345",))
-        user = cursor.fetchone()
+        user = _lookup_user("test-api-key-12345")
         
         if user:
-            print(f"✓ 用户验证成功: {user[1]} (ID: {user[0]})")
-            conn.close()
-            return user[0]  # 返回用户ID
+            user_id, username = user
+            print(f"✓ 用户验证成功: {username} (ID: {user_id})")
+            return user_id  # 返回用户ID
         else:
             print("✗ 用户验证失败")
-            conn.close()
             return None
     
     def test_session_management(self, user_id):
@@ -50,31 +151,39 @@ class SimpleAPITest:
         cursor = conn.cursor()
         
         # 创建新会话
-        cursor.execute("""
-            INSERT INTO sessions (user_id, title, model) 
-            VALUES (?, ?, ?)
-        """, (user_id, "API测试会话", "qwen2.5-7b"))
+        with conn:
+            cursor.execute(SQL_INSERT_SESSION, (user_id, "API测试会话", "qwen2.5-7b"))
+            
+            session_id = cursor.lastrowid
+            inserted = cursor.rowcount
         
-        session_id = cursor.lastrowid
-        conn.commit()
+        if inserted != 1:
+            print("✗ 创建会话失败")
+            return None
+        self._created_session_ids.append(session_id)
         
         print(f"✓ 创建会话成功: ID {session_id}")
         
-        # 获取用户所有会话
-        cursor.execute("""
-            SELECT id, title, model, created_at 
-            FROM sessions 
-            WHERE user_id = ? 
-            ORDER BY updated_at DESC
-        """, (user_id,))
-        
-        sessions = cursor.fetchall()
-        print(f"✓ 用户会话数量: {len(sessions)}")
-        
-        for session in sessions:
-            print(f"  - 会话 {session[0]}: {session[1]} ({session[2]})")
+        # 获取用户所有会话（仅--verbose时查询）
+        if self.verbose:
+            cursor.execute(SQL_LIST_SESSIONS, (user_id,))
+            
+            sessions = cursor.fetchall()
+            print(f"✓ 用户会话数量: {len(sessions)}")
+            sys.stdout.write("".join(
+                f"  - 会话 {session['id']}: {session['title']} ({session['model']})\n"
+                for session in sessions
+            ))
+        
+        # 排序应由idx_sessions_user直接提供，不应出现临时排序
+        cursor.execute("EXPLAIN QUERY PLAN " + SQL_LIST_SESSIONS, (user_id,))
+        plan = " ".join(row['detail'] for row in cursor.fetchall())
+        if "idx_sessions_user" in plan and "TEMP B-TREE" not in plan:
+            print("✓ 会话排序使用索引")
+        else:
+            print(f"✗ 会话排序未使用索引: {plan}")
+            return None
         
-        conn.close()
         return session_id
     
     def test_message_storage(self, session_id):
@@ -84,104 +193,102 @@ class SimpleAPITest:
         conn = self.get_db_connection()
         cursor = conn.cursor()
         
-        # 添加用户消息
-        cursor.execute("""
-            INSERT INTO messages (session_id, role, content) 
-            VALUES (?, ?, ?)
-        """, (session_id, "user", "这是一个API测试消息"))
-        
-        # 添加助手回复
-        cursor.execute("""
-            INSERT INTO messages (session_id, role, content) 
-            VALUES (?, ?, ?)
-        """, (session_id, "assistant", "收到您的测试消息，API功能正常工作。"))
-        
-        conn.commit()
-        
-        # 获取会话消息
-        cursor.execute("""
-            SELECT role, content, created_at 
-            FROM messages 
-            WHERE session_id = ? 
-            ORDER BY created_at ASC
-        """, (session_id,))
-        
-        messages = cursor.fetchall()
-        print(f"✓ 会话消息数量: {len(messages)}")
-        
-        for i, msg in enumerate(messages):
-            print(f"  {i+1}. [{msg[0]}]: {msg[1][:50]}...")
-        
-        conn.close()
-        return len(messages)
+        # 添加用户消息和助手回复
+        rows = [
+            (session_id, "user", "这是一个API测试消息"),
+            (session_id, "assistant", "收到您的测试消息，API功能正常工作。"),
+        ]
+        with conn:
+            cursor.executemany(SQL_INSERT_MESSAGE, rows)
+            message_count = cursor.rowcount
+        self._created_message_count += message_count
+        
+        print(f"✓ 写入消息数量: {message_count}")
+        
+        # 获取会话消息（仅--verbose时查询）
+        if self.verbose:
+            cursor.execute(SQL_LIST_MESSAGES, (session_id,))
+            
+            messages = cursor.fetchall()
+            print(f"✓ 会话消息数量: {len(messages)}")
+            sys.stdout.write("".join(
+                f"  {i+1}. [{msg['role']}]: {msg['content'][:50]}...\n"
+                for i, msg in enumerate(messages)
+            ))
+        
+        return message_count
     
     def test_request_logging(self, user_id):
         """测试请求日志功能"""
-        print("\n测试请求日志功能...")
+        self._print("\n测试请求日志功能...")
         
         conn = self.get_db_connection()
         cursor = conn.cursor()
         
         # 模拟API请求日志
-        cursor.execute("""
-            INSERT INTO request_logs (user_id, endpoint, method, status_code, response_time) 
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, "/v1/chat/completions", "POST", 200, 1.25))
-        
-        cursor.execute("""
-            INSERT INTO request_logs (user_id, endpoint, method, status_code, response_time) 
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, "/v1/sessions", "GET", 200, 0.15))
-        
-        conn.commit()
+        rows = [
+            (user_id, "/v1/chat/completions", "POST", 200, 1.25),
+            (user_id, "/v1/sessions", "GET", 200, 0.15),
+        ]
+        with conn:
+            cursor.executemany(SQL_INSERT_REQUEST_LOG, rows)
         
         # 获取请求统计
-        cursor.execute("""
-            SELECT COUNT(*) as total_requests,
-                   AVG(response_time) as avg_response_time,
-                   COUNT(CASE WHEN status_code = 200 THEN 1 END) as successful_requests
-            FROM request_logs 
-            WHERE user_id = ?
-        """, (user_id,))
+        cursor.execute(SQL_REQUEST_STATS, (user_id,))
         
         stats = cursor.fetchone()
         
-        print(f"✓ 总请求数: {stats[0]}")
-        print(f"✓ 平均响应时间: {stats[1]:.2f}s")
-        print(f"✓ 成功请求数: {stats[2]}")
+        self._print(f"✓ 总请求数: {stats['total_requests']}")
+        self._print(f"✓ 平均响应时间: {stats['avg_response_time']:.2f}s")
+        self._print(f"✓ 成功请求数: {stats['successful_requests']}")
         
-        conn.close()
         return stats
     
     def test_data_integrity(self):
         """测试数据完整性"""
-        print("\n测试数据完整性...")
+        self._print("\n测试数据完整性...")
         
         conn = self.get_db_connection()
         cursor = conn.cursor()
         
-        # 检查外键关系
-        cursor.execute("""
-            SELECT s.id, s.title, u.username 
-            FROM sessions s 
-            JOIN users u ON s.user_id = u.id
-        """)
+        # 检查本次创建的会话和消息的外键关系（两个关联计数合并为一次查询）
+        cursor.execute(SQL_INTEGRITY_COUNTS, {'session_ids': json.dumps(self._created_session_ids)})
+        counts = cursor.fetchone()
         
-        session_user_joins = cursor.fetchall()
-        print(f"✓ 会话-用户关联数: {len(session_user_joins)}")
+        session_user_joins = counts['session_user_joins']
+        self._print(f"✓ 会话-用户关联数: {session_user_joins}")
         
-        cursor.execute("""
-            SELECT m.id, m.role, s.title 
-            FROM messages m 
-            JOIN sessions s ON m.session_id = s.id
-        """)
+        message_session_joins = counts['message_session_joins']
+        self._print(f"✓ 消息-会话关联数: {message_session_joins}")
         
-        message_session_joins = cursor.fetchall()
-        print(f"✓ 消息-会话关联数: {len(message_session_joins)}")
+        # 本次创建的会话和消息都应能关联上
+        if (session_user_joins != len(self._created_session_ids)
+                or message_session_joins != self._created_message_count):
+            self._print("✗ 存在未关联的测试数据")
+            return False
         
-        conn.close()
         return True
     
+    async def _run_in_thread(self, test, *args):
+        """在工作线程中用独立连接执行测试方法，返回(结果, 缓冲的输出)"""
+        def run():
+            self._local.conn = _open_connection()
+            self._local.output = []
+            try:
+                return test(*args), "".join(self._local.output)
+            finally:
+                self._local.conn.close()
+                self._local.conn = None
+                self._local.output = None
+        return await asyncio.to_thread(run)
+    
+    async def _run_independent_tests(self, user_id):
+        """并发运行互不依赖的请求日志和数据完整性测试（WAL模式下读写互不阻塞）"""
+        return await asyncio.gather(
+            self._run_in_thread(self.test_request_logging, user_id),
+            self._run_in_thread(self.test_data_integrity),
+        )
+    
     def run_all_tests(self):
         """运行所有测试"""
         print("开始API功能测试...\n")
@@ -202,13 +309,14 @@ class SimpleAPITest:
             if message_count == 0:
                 return False
             
-            # 测试请求日志
-            stats = self.test_request_logging(user_id)
+            # 测试请求日志和数据完整性（两者互不依赖）
+            (stats, logging_output), (integrity_ok, integrity_output) = \
+                asyncio.run(self._run_independent_tests(user_id))
+            sys.stdout.write(logging_output + integrity_output)
             if not stats:
                 return False
             
-            # 测试数据完整性
-            if not self.test_data_integrity():
+            if not integrity_ok:
                 return False
             
             print("\n🎉 所有API功能测试通过！")
@@ -217,17 +325,18 @@ class SimpleAPITest:
         except Exception as e:
             print(f"\n❌ 测试失败: {e}")
             return False
+        finally:
+            self.close()
 
 def main():
     """主函数"""
     # 确保数据库存在
-    db_path = Path("../volume/database/conversations.db")
-    if not db_path.exists():
+    if not DB_PATH.exists():
         print("❌ 数据库不存在，请先运行 test_basic.py")
         return False
     
-    # 运行API测试
-    tester = SimpleAPITest()
+    # 运行API测试（--verbose：写入后查询并打印会话和消息列表）
+    tester = SimpleAPITest(verbose="--verbose" in sys.argv[1:])
     success = tester.run_all_tests()
     
     return success
@@ -5,6 +5,8 @@
 """
 
 import asyncio
+import mmap
+import re
 import sqlite3
 import os
 import sys
@@ -13,98 +15,103 @@ from pathlib import Path
 # 添加当前目录到Python路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+# 路径常量（相对脚本所在目录解析，不依赖当前工作目录）
+HERE = Path(__file__).resolve().parent
+VOLUME_DIR = HERE.parent / "volume"
+DB_DIR = VOLUME_DIR / "database"
+DB_PATH = DB_DIR / "conversations.db"
+DB_PATH_STR = str(DB_PATH)
+ENV_PATH = HERE.parent / ".env"
+
+# 测试库的SQLite连接参数（test_api_simple.py共用）：WAL模式下提交只需追加写，NORMAL同步少一次fsync。
+# 网关的连接参数见database.py，另外还设置了busy_timeout、mmap_size和foreign_keys
+SQLITE_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY", "cache_size=-65536")
+
+# .env中需要检查的配置项
+ENV_KEYS = ("API_KEY", "VLLM_URL", "DATABASE_URL")
+ENV_KEYS_PATTERN = re.compile("|".join(ENV_KEYS).encode())
+
+# 测试数据库结构
+SCHEMA_SQL = """
+    -- 用户表（按api_key聚簇存储，认证查找只需一次B树探查）
+    CREATE TABLE IF NOT EXISTS users (
+        api_key VARCHAR(100) PRIMARY KEY,
+        id INTEGER UNIQUE NOT NULL,
+        username VARCHAR(50) UNIQUE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+    
+    -- 会话表
+    CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        title VARCHAR(200),
+        model VARCHAR(50),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+    
+    -- 消息表
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER NOT NULL,
+        role VARCHAR(20) NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES sessions (id)
+    );
+    
+    -- 请求日志表
+    CREATE TABLE IF NOT EXISTS request_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        endpoint VARCHAR(100),
+        method VARCHAR(10),
+        status_code INTEGER,
+        response_time FLOAT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    );
+    
+    -- 为外键和常用过滤/排序列创建索引（统计查询只读user_id/status_code/response_time，覆盖索引可避免回表）
+    CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id, updated_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, created_at);
+    CREATE INDEX IF NOT EXISTS idx_reqlog_user ON request_logs (user_id, status_code, response_time);
+"""
+
+# 测试数据
+SEED_SQL = """
+    INSERT INTO users (id, username, api_key) 
+    VALUES (1, 'test_user', 'test-api-key-12345');
+    
+    INSERT INTO sessions (user_id, title, model) 
+    VALUES (1, '测试会话', 'qwen2.5-7b');
+    
+    INSERT INTO messages (session_id, role, content) 
+    VALUES (1, 'user', '你好，这是一个测试消息'),
+           (1, 'assistant', '你好！我是AI助手，很高兴为您服务。');
+"""
+
 def test_database_creation():
     """测试数据库创建"""
     print("测试数据库创建...")
     
     # 创建测试数据库目录
-    db_dir = Path("../volume/database")
-    db_dir.mkdir(parents=True, exist_ok=True)
-    
-    db_path = db_dir / "conversations.db"
+    DB_DIR.mkdir(parents=True, exist_ok=True)
     
     # 如果数据库存在，先删除
-    if db_path.exists():
-        db_path.unlink()
+    DB_PATH.unlink(missing_ok=True)
     
-    # 创建数据库连接
-    conn = sqlite3.connect(str(db_path))
+    # 创建数据库连接（手动管理事务，建表和插入放在同一个事务中，只需一次fsync）
+    conn = sqlite3.connect(DB_PATH_STR, isolation_level=None)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
     cursor = conn.cursor()
     
-    # 创建用户表
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(50) UNIQUE NOT NULL,
-            api_key VARCHAR(100) UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # 创建会话表
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title VARCHAR(200),
-            model VARCHAR(50),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-    
-    # 创建消息表
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id INTEGER NOT NULL,
-            role VARCHAR(20) NOT NULL,
-            content TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (session_id) REFERENCES sessions (id)
-        )
-    """)
-    
-    # 创建请求日志表
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS request_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            endpoint VARCHAR(100),
-            method VARCHAR(10),
-            status_code INTEGER,
-            response_time FLOAT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    """)
-    
-    # 插入测试用户
-    cursor.execute("""
-        INSERT INTO users (username, api_key) 
-        VALUES ('test_user', 'test-api-key-12345')
-    """)
-    
-    # 插入测试会话
-    cursor.execute("""
-        INSERT INTO sessions (user_id, title, model) 
-        VALUES (1, '测试会话', 'qwen2.5-7b')
-    """)
-    
-    # 插入测试消息
-    cursor.execute("""
-        INSERT INTO messages (session_id, role, content) 
-        VALUES (1, 'user', '你好，这是一个测试消息')
-    """)
-    
-    cursor.execute("""
-        INSERT INTO messages (session_id, role, content) 
-        VALUES (1, 'assistant', '你好！我是AI助手，很高兴为您服务。')
-    """)
-    
-    conn.commit()
+    # 建表、建索引并插入测试数据，整个脚本一次提交给SQLite执行
+    cursor.executescript(f"BEGIN;{SCHEMA_SQL}{SEED_SQL}COMMIT;")
     
     # 验证数据
     cursor.execute("SELECT COUNT(*) FROM users")
@@ -129,48 +136,45 @@ def test_env_file():
     """测试环境配置文件"""
     print("\n测试环境配置文件...")
     
-    env_path = Path("../.env")
-    if env_path.exists():
-        print("✓ .env 文件存在")
-        with open(env_path, 'r') as f:
-            content = f.read()
-            if 'API_KEY' in content:
-                print("✓ API_KEY 配置存在")
-            if 'VLLM_URL' in content:
-                print("✓ VLLM_URL 配置存在")
-            if 'DATABASE_URL' in content:
-                print("✓ DATABASE_URL 配置存在")
-    else:
+    # 直接打开文件，不存在时由open报错，省去单独的exists检查
+    try:
+        with open(ENV_PATH, 'rb') as f:
+            # 映射文件后用一个正则扫描一遍，找出出现过的配置项（空文件无法映射）
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    found = {m.group(0).decode() for m in ENV_KEYS_PATTERN.finditer(mm)}
+            else:
+                found = set()
+    except FileNotFoundError:
         print("✗ .env 文件不存在")
         return False
     
+    print("✓ .env 文件存在")
+    for key in ENV_KEYS:
+        if key in found:
+            print(f"✓ {key} 配置存在")
+    
     return True
 
 def test_volume_directories():
     """测试卷目录结构"""
     print("\n测试卷目录结构...")
     
-    volume_dir = Path("../volume")
-    logs_dir = volume_dir / "logs"
-    db_dir = volume_dir / "database"
-    
-    if volume_dir.exists():
+    # 一次读取volume目录项，代替对每个子目录单独stat
+    try:
+        with os.scandir(VOLUME_DIR) as entries:
+            subdirs = {entry.name for entry in entries if entry.is_dir()}
         print("✓ volume 目录存在")
-    else:
+    except FileNotFoundError:
         print("✗ volume 目录不存在")
         return False
     
-    if logs_dir.exists():
-        print("✓ logs 目录存在")
-    else:
-        print("✗ logs 目录不存在")
-        return False
-    
-    if db_dir.exists():
-        print("✓ database 目录存在")
-    else:
-        print("✗ database 目录不存在")
-        return False
+    for name in ("logs", "database"):
+        if name in subdirs:
+            print(f"✓ {name} 目录存在")
+        else:
+            print(f"✗ {name} 目录不存在")
+            return False
     
     return True
 